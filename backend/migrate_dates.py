@@ -0,0 +1,46 @@
+"""One-time migration: convert ISO-string timestamps to native BSON dates.
+
+Older documents stored ``datetime.isoformat()`` strings; the API now writes
+real datetimes and no longer re-parses strings on read. Safe to re-run.
+
+    python migrate_dates.py
+"""
+import asyncio
+import os
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+TIMESTAMP_FIELDS = {
+    "users": ["created_at"],
+    "products": ["created_at"],
+    "reviews": ["created_at"],
+    "orders": ["created_at"],
+    "payment_transactions": ["created_at"],
+    "newsletter": ["subscribed_at"],
+}
+
+async def migrate():
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    
+    for collection, fields in TIMESTAMP_FIELDS.items():
+        for field in fields:
+            ops = []
+            async for doc in db[collection].find({field: {"$type": "string"}}, {field: 1}):
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {field: datetime.fromisoformat(doc[field])}}))
+            
+            if ops:
+                await db[collection].bulk_write(ops, ordered=False)
+            print(f"{collection}.{field}: {len(ops)} converted")
+    
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
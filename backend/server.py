@@ -1,68 +1,126 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, WebSocket, WebSocketDisconnect, Request, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, WebSocket, WebSocketDisconnect, Request, Response, BackgroundTasks
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from websockets.exceptions import ConnectionClosed
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
-import uuid
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, TypeAdapter
+from typing import List, Set, Optional, Dict, Any
+import secrets
 from datetime import datetime, timezone, timedelta
 import bcrypt
 from jose import jwt, JWTError
 import httpx
-import json
+import orjson
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import re
+import hashlib
+import time
+from cachetools import TTLCache
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+# Multi-document transactions need a replica set or sharded cluster; detected at startup
+transactions_supported = False
+
 # JWT Config
 JWT_SECRET = os.environ.get('JWT_SECRET_KEY', 'default_secret')
 JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
 ACCESS_TOKEN_EXPIRE = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', 1440))
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 10))
+# Unpaid orders give their reserved stock back after this long
+PENDING_ORDER_TTL_MINUTES = int(os.environ.get('PENDING_ORDER_TTL_MINUTES', 60))
 
 # OpenAI Config
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
 
 # Stripe Config
 STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY', '')
+# Basic auth header for the REST fallback, encoded once
+STRIPE_AUTH = httpx.BasicAuth(STRIPE_API_KEY, "")
+
+# The Stripe SDK is optional; the payment routes fall back to the REST API without it
+try:
+    from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionRequest
+    STRIPE_SDK_AVAILABLE = True
+except ImportError:
+    STRIPE_SDK_AVAILABLE = False
 
 # Create the main app
-app = FastAPI(title="NexusMarket API", version="1.0.0")
+app = FastAPI(title="NexusMarket API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Shared outbound HTTP client (keeps TLS connections warm); created at startup
+http_client: Optional[httpx.AsyncClient] = None
+
 # Security
 security = HTTPBearer(auto_error=False)
 
+# Decoded token -> (exp, User) cache; the short TTL keeps role/profile changes visible
+AUTH_CACHE_TTL = 5
+auth_cache = TTLCache(maxsize=10_000, ttl=AUTH_CACHE_TTL)
+
+# Trending products are the same for every caller, so share them briefly
+TRENDING_CACHE_TTL = 30
+trending_cache = TTLCache(maxsize=1, ttl=TRENDING_CACHE_TTL)
+trending_lock = asyncio.Lock()
+
 # WebSocket connection manager for real-time inventory
+BROADCAST_SEND_TIMEOUT = 1.0
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
+        self.lock = asyncio.Lock()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        async with self.lock:
+            self.active_connections.add(websocket)
 
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+    async def disconnect(self, websocket: WebSocket):
+        async with self.lock:
+            self.active_connections.discard(websocket)
+
+    async def send(self, connection: WebSocket, payload: str) -> bool:
+        # A stuck client gets dropped instead of holding up the whole broadcast
+        try:
+            await asyncio.wait_for(connection.send_text(payload), timeout=BROADCAST_SEND_TIMEOUT)
+            return True
+        except (WebSocketDisconnect, ConnectionClosed, RuntimeError, asyncio.TimeoutError):
+            return False
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except:
-                pass
+        # Nobody is listening, so skip encoding altogether
+        if not self.active_connections:
+            return
+        
+        # Encode once and send to every client concurrently
+        payload = orjson.dumps(message).decode()
+        async with self.lock:
+            connections = list(self.active_connections)
+        results = await asyncio.gather(*(self.send(connection, payload) for connection in connections))
+        
+        # Drop clients whose send failed so dead sockets don't accumulate
+        dead = [c for c, sent in zip(connections, results) if not sent]
+        if dead:
+            async with self.lock:
+                self.active_connections.difference_update(dead)
 
 manager = ConnectionManager()
 
@@ -132,7 +190,7 @@ class Product(BaseModel):
 
 class CartItem(BaseModel):
     product_id: str
-    quantity: int
+    quantity: int = Field(..., gt=0)
 
 class CartUpdate(BaseModel):
     items: List[CartItem]
@@ -156,7 +214,7 @@ class OrderItem(BaseModel):
     product_id: str
     product_name: str
     price: float
-    quantity: int
+    quantity: int = Field(..., gt=0)
     image: Optional[str] = None
 
 class OrderCreate(BaseModel):
@@ -187,13 +245,38 @@ class CheckoutRequest(BaseModel):
     order_id: str
     origin_url: str
 
+# List adapters validate and serialize whole result sets inside pydantic-core
+products_adapter = TypeAdapter(List[Product])
+orders_adapter = TypeAdapter(List[Order])
+reviews_adapter = TypeAdapter(List[Review])
+
+def list_response(adapter: TypeAdapter, docs: list) -> Response:
+    # Returning a Response skips FastAPI's second response_model pass
+    return Response(content=adapter.dump_json(adapter.validate_python(docs)), media_type="application/json")
+
+def generate_id(prefix: str) -> str:
+    # 9 random bytes -> 12 URL-safe chars (72 bits) from a single CSPRNG draw
+    return f"{prefix}_{secrets.token_urlsafe(9)}"
+
 # ============== AUTH HELPERS ==============
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+async def hash_password(password: str) -> str:
+    # bcrypt holds the CPU for tens of ms; keep it off the event loop
+    hashed = await asyncio.to_thread(bcrypt.hashpw, password.encode(), bcrypt.gensalt(BCRYPT_ROUNDS))
+    return hashed.decode()
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode(), hashed.encode())
+def needs_rehash(hashed: str) -> bool:
+    # bcrypt hashes look like $2b$<rounds>$<salt+digest>
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await asyncio.to_thread(bcrypt.checkpw, password.encode(), hashed.encode())
+
+# Checked against when an account is missing or has no password, so every failed login costs one bcrypt
+DUMMY_PASSWORD_HASH = bcrypt.hashpw(b"nexusmarket", bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
@@ -201,20 +284,33 @@ def create_access_token(data: dict) -> str:
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), request: Request = None) -> Optional[User]:
-    token = None
-    
+def get_request_token(credentials: Optional[HTTPAuthorizationCredentials], request: Optional[Request]) -> Optional[str]:
     # Try to get token from Authorization header
     if credentials:
-        token = credentials.credentials
+        return credentials.credentials
     
     # Try to get token from cookie
-    if not token and request:
-        token = request.cookies.get("session_token")
+    if request:
+        return request.cookies.get("session_token")
     
+    return None
+
+def auth_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), request: Request = None) -> Optional[User]:
+    token = get_request_token(credentials, request)
     if not token:
         return None
     
+    key = auth_cache_key(token)
+    cached = auth_cache.get(key)
+    if cached:
+        exp, user = cached
+        if exp > time.time():
+            return user
+        auth_cache.pop(key, None)
+    
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id = payload.get("sub")
@@ -225,10 +321,11 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if not user_doc:
             return None
         
-        if isinstance(user_doc.get('created_at'), str):
-            user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-        
-        return User(**user_doc)
+        user = User(**user_doc)
+        # Never serve a cached user past the token's own expiry
+        exp = min(time.time() + AUTH_CACHE_TTL, payload.get("exp", 0))
+        auth_cache[key] = (exp, user)
+        return user
     except JWTError:
         return None
 
@@ -251,39 +348,56 @@ async def require_admin(user: User = Depends(require_auth)) -> User:
 
 @api_router.post("/auth/register", response_model=TokenResponse)
 async def register(data: UserCreate):
-    existing = await db.users.find_one({"email": data.email})
+    # Overlap the duplicate-email lookup with the bcrypt hash
+    existing, password_hash = await asyncio.gather(
+        db.users.find_one({"email": data.email}, {"_id": 1}),
+        hash_password(data.password)
+    )
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    user_id = generate_id("user")
     user_doc = {
         "user_id": user_id,
         "email": data.email,
         "name": data.name,
-        "password_hash": hash_password(data.password),
+        "password_hash": password_hash,
         "role": data.role,
         "picture": None,
         "loyalty_points": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration for the same email
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     token = create_access_token({"sub": user_id})
     user_doc.pop("password_hash")
-    user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
     
     return TokenResponse(access_token=token, user=User(**user_doc))
 
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(data: UserLogin, response: Response):
     user_doc = await db.users.find_one({"email": data.email}, {"_id": 0})
-    if not user_doc:
+    password_hash = user_doc.get("password_hash") if user_doc else None
+    if not password_hash:
+        # Same bcrypt cost as a real check, so response timing doesn't reveal which emails exist
+        await verify_password(data.password, DUMMY_PASSWORD_HASH)
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    if not verify_password(data.password, user_doc.get("password_hash", "")):
+    if not await verify_password(data.password, password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade hashes created with a different cost factor
+    if needs_rehash(password_hash):
+        await db.users.update_one(
+            {"user_id": user_doc["user_id"]},
+            {"$set": {"password_hash": await hash_password(data.password)}}
+        )
+    
     token = create_access_token({"sub": user_doc["user_id"]})
     
     # Set cookie
@@ -297,9 +411,6 @@ async def login(data: UserLogin, response: Response):
     )
     
     user_doc.pop("password_hash", None)
-    if isinstance(user_doc.get('created_at'), str):
-        user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-    
     return TokenResponse(access_token=token, user=User(**user_doc))
 
 @api_router.get("/auth/me", response_model=User)
@@ -307,7 +418,10 @@ async def get_me(user: User = Depends(require_auth)):
     return user
 
 @api_router.post("/auth/logout")
-async def logout(response: Response):
+async def logout(request: Request, response: Response, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = get_request_token(credentials, request)
+    if token:
+        auth_cache.pop(auth_cache_key(token), None)
     response.delete_cookie("session_token")
     return {"message": "Logged out successfully"}
 
@@ -318,39 +432,33 @@ async def get_session_data(request: Request, response: Response):
     if not session_id:
         raise HTTPException(status_code=400, detail="Session ID required")
     
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-            headers={"X-Session-ID": session_id}
-        )
-        if resp.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid session")
-        
-        data = resp.json()
-    
-    # Check if user exists
-    existing = await db.users.find_one({"email": data["email"]}, {"_id": 0})
-    
-    if existing:
-        user_id = existing["user_id"]
-        # Update user info
-        await db.users.update_one(
-            {"user_id": user_id},
-            {"$set": {"name": data["name"], "picture": data.get("picture")}}
-        )
-    else:
-        user_id = f"user_{uuid.uuid4().hex[:12]}"
-        await db.users.insert_one({
-            "user_id": user_id,
-            "email": data["email"],
-            "name": data["name"],
-            "picture": data.get("picture"),
-            "role": "customer",
-            "loyalty_points": 0,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        })
+    resp = await http_client.get(
+        "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
+        headers={"X-Session-ID": session_id}
+    )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=401, detail="Invalid session")
+    
+    data = resp.json()
+    
+    # Update user info, creating the user on first login, in a single round trip
+    user_doc = await db.users.find_one_and_update(
+        {"email": data["email"]},
+        {
+            "$set": {"name": data["name"], "picture": data.get("picture")},
+            "$setOnInsert": {
+                "user_id": generate_id("user"),
+                "role": "customer",
+                "loyalty_points": 0,
+                "created_at": datetime.now(timezone.utc)
+            }
+        },
+        projection={"_id": 0, "password_hash": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
     
-    token = create_access_token({"sub": user_id})
+    token = create_access_token({"sub": user_doc["user_id"]})
     
     # Set cookie
     response.set_cookie(
@@ -362,22 +470,17 @@ async def get_session_data(request: Request, response: Response):
         max_age=ACCESS_TOKEN_EXPIRE * 60
     )
     
-    user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-    if isinstance(user_doc.get('created_at'), str):
-        user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-    
     return {"user": User(**user_doc), "session_token": token}
 
 # ============== CATEGORY ROUTES ==============
 
 @api_router.get("/categories", response_model=List[Category])
 async def get_categories():
-    categories = await db.categories.find({}, {"_id": 0}).to_list(100)
-    return categories
+    return [c async for c in db.categories.find({}, {"_id": 0}).limit(100)]
 
 @api_router.post("/categories", response_model=Category)
 async def create_category(data: Category, user: User = Depends(require_admin)):
-    data.category_id = f"cat_{uuid.uuid4().hex[:8]}"
+    data.category_id = generate_id("cat")
     await db.categories.insert_one(data.model_dump())
     return data
 
@@ -390,21 +493,24 @@ async def get_products(
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
     min_rating: Optional[float] = None,
-    sort: Optional[str] = "newest",
+    sort: Optional[str] = None,
+    prefix: bool = False,
     limit: int = Query(20, le=100),
     skip: int = 0
 ):
     query = {}
+    projection = {"_id": 0}
     
     if category:
         query["category_id"] = category
     
     if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"tags": {"$in": [search.lower()]}}
-        ]
+        if prefix:
+            # Anchored, case-sensitive prefix match can use the B-tree index on name
+            query["name"] = {"$regex": f"^{re.escape(search)}"}
+        else:
+            query["$text"] = {"$search": search}
+            projection["score"] = {"$meta": "textScore"}
     
     if min_price is not None:
         query["price"] = {"$gte": min_price}
@@ -414,15 +520,13 @@ async def get_products(
     if min_rating is not None:
         query["rating"] = {"$gte": min_rating}
     
-    sort_field = {"newest": ("created_at", -1), "price_low": ("price", 1), "price_high": ("price", -1), "rating": ("rating", -1)}.get(sort, ("created_at", -1))
-    
-    products = await db.products.find(query, {"_id": 0}).sort(*sort_field).skip(skip).limit(limit).to_list(limit)
-    
-    for p in products:
-        if isinstance(p.get('created_at'), str):
-            p['created_at'] = datetime.fromisoformat(p['created_at'])
+    if sort is None and "$text" in query:
+        sort_field = ("score", {"$meta": "textScore"})
+    else:
+        sort_field = {"newest": ("created_at", -1), "price_low": ("price", 1), "price_high": ("price", -1), "rating": ("rating", -1)}.get(sort, ("created_at", -1))
     
-    return products
+    cursor = db.products.find(query, projection).sort(*sort_field).skip(skip).limit(limit)
+    return list_response(products_adapter, [p async for p in cursor])
 
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
@@ -430,24 +534,20 @@ async def get_product(product_id: str):
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    if isinstance(product.get('created_at'), str):
-        product['created_at'] = datetime.fromisoformat(product['created_at'])
-    
     return product
 
 @api_router.post("/products", response_model=Product)
 async def create_product(data: ProductCreate, user: User = Depends(require_seller)):
-    product_id = f"prod_{uuid.uuid4().hex[:8]}"
+    product_id = generate_id("prod")
     product = {
         "product_id": product_id,
         "seller_id": user.user_id,
         **data.model_dump(),
         "rating": 0.0,
         "review_count": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     await db.products.insert_one(product)
-    product['created_at'] = datetime.fromisoformat(product['created_at'])
     
     # Broadcast inventory update
     await manager.broadcast({"type": "product_added", "product_id": product_id, "stock": data.stock})
@@ -456,23 +556,25 @@ async def create_product(data: ProductCreate, user: User = Depends(require_selle
 
 @api_router.put("/products/{product_id}", response_model=Product)
 async def update_product(product_id: str, data: ProductCreate, user: User = Depends(require_seller)):
-    product = await db.products.find_one({"product_id": product_id}, {"_id": 0})
+    query = {"product_id": product_id}
+    if user.role != "admin":
+        query["seller_id"] = user.user_id
+    
+    # Update and read the previous stock in one round trip
+    changes = data.model_dump()
+    product = await db.products.find_one_and_update(
+        query,
+        {"$set": changes},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
     if not product:
+        if await db.products.find_one({"product_id": product_id}, {"_id": 1}):
+            raise HTTPException(status_code=403, detail="Not authorized")
         raise HTTPException(status_code=404, detail="Product not found")
     
-    if product["seller_id"] != user.user_id and user.role != "admin":
-        raise HTTPException(status_code=403, detail="Not authorized")
-    
     old_stock = product.get("stock", 0)
-    
-    await db.products.update_one(
-        {"product_id": product_id},
-        {"$set": data.model_dump()}
-    )
-    
-    updated = await db.products.find_one({"product_id": product_id}, {"_id": 0})
-    if isinstance(updated.get('created_at'), str):
-        updated['created_at'] = datetime.fromisoformat(updated['created_at'])
+    updated = {**product, **changes}
     
     # Broadcast inventory update if stock changed
     if data.stock != old_stock:
@@ -482,7 +584,7 @@ async def update_product(product_id: str, data: ProductCreate, user: User = Depe
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str, user: User = Depends(require_seller)):
-    product = await db.products.find_one({"product_id": product_id})
+    product = await db.products.find_one({"product_id": product_id}, {"_id": 0, "seller_id": 1})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
@@ -502,12 +604,20 @@ async def get_cart(user: User = Depends(require_auth)):
     if not cart:
         return {"items": [], "total": 0}
     
-    # Get product details
+    # Get product details in a single round trip
+    items = cart.get("items", [])
+    ids = [item["product_id"] for item in items]
+    cursor = db.products.find(
+        {"product_id": {"$in": ids}},
+        {"_id": 0, "product_id": 1, "name": 1, "price": 1, "images": {"$slice": 1}, "stock": 1}
+    )
+    products = {p["product_id"]: p async for p in cursor}
+    
     items_with_details = []
     total = 0
     
-    for item in cart.get("items", []):
-        product = await db.products.find_one({"product_id": item["product_id"]}, {"_id": 0})
+    for item in items:
+        product = products.get(item["product_id"])
         if product:
             item_total = product["price"] * item["quantity"]
             total += item_total
@@ -526,36 +636,32 @@ async def get_cart(user: User = Depends(require_auth)):
 
 @api_router.post("/cart/add")
 async def add_to_cart(item: CartItem, user: User = Depends(require_auth)):
-    product = await db.products.find_one({"product_id": item.product_id})
+    product = await db.products.find_one({"product_id": item.product_id}, {"_id": 0, "stock": 1})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
     if product["stock"] < item.quantity:
         raise HTTPException(status_code=400, detail="Insufficient stock")
     
-    cart = await db.carts.find_one({"user_id": user.user_id})
-    
-    if cart:
-        # Check if item exists
-        existing_item = next((i for i in cart.get("items", []) if i["product_id"] == item.product_id), None)
-        if existing_item:
-            new_qty = existing_item["quantity"] + item.quantity
-            if new_qty > product["stock"]:
-                raise HTTPException(status_code=400, detail="Insufficient stock")
-            await db.carts.update_one(
-                {"user_id": user.user_id, "items.product_id": item.product_id},
-                {"$set": {"items.$.quantity": new_qty}}
-            )
-        else:
-            await db.carts.update_one(
-                {"user_id": user.user_id},
-                {"$push": {"items": item.model_dump()}}
-            )
+    cart = await db.carts.find_one({"user_id": user.user_id}, {"_id": 0, "items": 1})
+    
+    # Check if item exists
+    existing_item = next((i for i in (cart or {}).get("items", []) if i["product_id"] == item.product_id), None)
+    if existing_item:
+        new_qty = existing_item["quantity"] + item.quantity
+        if new_qty > product["stock"]:
+            raise HTTPException(status_code=400, detail="Insufficient stock")
+        await db.carts.update_one(
+            {"user_id": user.user_id, "items.product_id": item.product_id},
+            {"$set": {"items.$.quantity": new_qty}}
+        )
     else:
-        await db.carts.insert_one({
-            "user_id": user.user_id,
-            "items": [item.model_dump()]
-        })
+        # Upsert so concurrent first adds share one cart instead of racing to insert
+        await db.carts.update_one(
+            {"user_id": user.user_id},
+            {"$push": {"items": item.model_dump()}},
+            upsert=True
+        )
     
     return {"message": "Added to cart"}
 
@@ -589,19 +695,24 @@ async def get_wishlist(user: User = Depends(require_auth)):
     if not wishlist:
         return {"items": []}
     
+    product_ids = wishlist.get("product_ids", [])
+    cursor = db.products.find(
+        {"product_id": {"$in": product_ids}},
+        {"_id": 0, "product_id": 1, "name": 1, "price": 1, "images": {"$slice": 1}, "stock": 1, "rating": 1, "review_count": 1}
+    )
+    by_id = {p["product_id"]: p async for p in cursor}
+    
     products = []
-    for pid in wishlist.get("product_ids", []):
-        product = await db.products.find_one({"product_id": pid}, {"_id": 0})
+    for pid in product_ids:
+        product = by_id.get(pid)
         if product:
-            if isinstance(product.get('created_at'), str):
-                product['created_at'] = datetime.fromisoformat(product['created_at'])
             products.append(product)
     
     return {"items": products}
 
 @api_router.post("/wishlist/{product_id}")
 async def add_to_wishlist(product_id: str, user: User = Depends(require_auth)):
-    product = await db.products.find_one({"product_id": product_id})
+    product = await db.products.find_one({"product_id": product_id}, {"_id": 1})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
@@ -624,20 +735,17 @@ async def remove_from_wishlist(product_id: str, user: User = Depends(require_aut
 
 @api_router.get("/products/{product_id}/reviews", response_model=List[Review])
 async def get_product_reviews(product_id: str):
-    reviews = await db.reviews.find({"product_id": product_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    for r in reviews:
-        if isinstance(r.get('created_at'), str):
-            r['created_at'] = datetime.fromisoformat(r['created_at'])
-    return reviews
+    cursor = db.reviews.find({"product_id": product_id}, {"_id": 0}).sort("created_at", -1).limit(100)
+    return list_response(reviews_adapter, [r async for r in cursor])
 
 @api_router.post("/reviews", response_model=Review)
-async def create_review(data: ReviewCreate, user: User = Depends(require_auth)):
+async def create_review(data: ReviewCreate, background_tasks: BackgroundTasks, user: User = Depends(require_auth)):
     # Check if user already reviewed
-    existing = await db.reviews.find_one({"product_id": data.product_id, "user_id": user.user_id})
+    existing = await db.reviews.find_one({"product_id": data.product_id, "user_id": user.user_id}, {"_id": 1})
     if existing:
         raise HTTPException(status_code=400, detail="Already reviewed this product")
     
-    review_id = f"rev_{uuid.uuid4().hex[:8]}"
+    review_id = generate_id("rev")
     review = {
         "review_id": review_id,
         "product_id": data.product_id,
@@ -645,21 +753,30 @@ async def create_review(data: ReviewCreate, user: User = Depends(require_auth)):
         "user_name": user.name,
         "rating": data.rating,
         "comment": data.comment,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
-    await db.reviews.insert_one(review)
-    
-    # Update product rating
-    all_reviews = await db.reviews.find({"product_id": data.product_id}).to_list(1000)
-    avg_rating = sum(r["rating"] for r in all_reviews) / len(all_reviews)
-    await db.products.update_one(
-        {"product_id": data.product_id},
-        {"$set": {"rating": round(avg_rating, 1), "review_count": len(all_reviews)}}
-    )
+    try:
+        await db.reviews.insert_one(review)
+    except DuplicateKeyError:
+        # A concurrent request from the same user got there first
+        raise HTTPException(status_code=400, detail="Already reviewed this product")
+    
+    # Update product rating after the response is sent
+    background_tasks.add_task(recompute_product_rating, data.product_id)
     
-    review['created_at'] = datetime.fromisoformat(review['created_at'])
     return review
 
+async def recompute_product_rating(product_id: str):
+    agg = await db.reviews.aggregate([
+        {"$match": {"product_id": product_id}},
+        {"$group": {"_id": None, "avg": {"$avg": "$rating"}, "n": {"$sum": 1}}}
+    ]).to_list(1)
+    if agg:
+        await db.products.update_one(
+            {"product_id": product_id},
+            {"$set": {"rating": round(agg[0]["avg"], 1), "review_count": agg[0]["n"]}}
+        )
+
 # ============== ORDER ROUTES ==============
 
 @api_router.get("/orders", response_model=List[Order])
@@ -669,15 +786,12 @@ async def get_orders(user: User = Depends(require_auth)):
         query = {}
     elif user.role == "seller":
         # Get orders containing seller's products
-        seller_products = await db.products.find({"seller_id": user.user_id}).to_list(1000)
-        product_ids = [p["product_id"] for p in seller_products]
+        cursor = db.products.find({"seller_id": user.user_id}, {"_id": 0, "product_id": 1}).limit(1000)
+        product_ids = [p["product_id"] async for p in cursor]
         query = {"items.product_id": {"$in": product_ids}}
     
-    orders = await db.orders.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
-    for o in orders:
-        if isinstance(o.get('created_at'), str):
-            o['created_at'] = datetime.fromisoformat(o['created_at'])
-    return orders
+    cursor = db.orders.find(query, {"_id": 0}).sort("created_at", -1).limit(100)
+    return list_response(orders_adapter, [o async for o in cursor])
 
 @api_router.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: str, user: User = Depends(require_auth)):
@@ -688,32 +802,49 @@ async def get_order(order_id: str, user: User = Depends(require_auth)):
     if order["user_id"] != user.user_id and user.role not in ["admin", "seller"]:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    if isinstance(order.get('created_at'), str):
-        order['created_at'] = datetime.fromisoformat(order['created_at'])
-    
     return order
 
 @api_router.post("/orders", response_model=Order)
 async def create_order(data: OrderCreate, user: User = Depends(require_auth)):
-    # Validate items and calculate totals
-    subtotal = 0
-    for item in data.items:
-        product = await db.products.find_one({"product_id": item.product_id})
+    # Reserve stock atomically; the filter rejects items without enough stock
+    reserved = await asyncio.gather(*(
+        db.products.find_one_and_update(
+            {"product_id": item.product_id, "stock": {"$gte": item.quantity}},
+            {"$inc": {"stock": -item.quantity}},
+            projection={"_id": 0, "product_id": 1, "name": 1, "price": 1, "stock": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        for item in data.items
+    ))
+    
+    failed = next((item for item, product in zip(data.items, reserved) if product is None), None)
+    if failed:
+        # Give back whatever was reserved before rejecting the order
+        await release_stock([
+            {"product_id": item.product_id, "quantity": item.quantity}
+            for item, product in zip(data.items, reserved) if product is not None
+        ])
+        product = await db.products.find_one({"product_id": failed.product_id}, {"_id": 0, "name": 1})
         if not product:
-            raise HTTPException(status_code=400, detail=f"Product {item.product_id} not found")
-        if product["stock"] < item.quantity:
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}")
-        subtotal += item.price * item.quantity
+            raise HTTPException(status_code=400, detail=f"Product {failed.product_id} not found")
+        raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}")
+    
+    # Price from the catalog rather than the client-supplied item price
+    subtotal = sum(product["price"] * item.quantity for item, product in zip(data.items, reserved))
     
     tax = round(subtotal * 0.1, 2)  # 10% tax
     shipping = 10.00 if subtotal < 100 else 0.00
     total = round(subtotal + tax + shipping, 2)
     
-    order_id = f"ord_{uuid.uuid4().hex[:8]}"
+    order_id = generate_id("ord")
     order = {
         "order_id": order_id,
         "user_id": user.user_id,
-        "items": [i.model_dump() for i in data.items],
+        # Store catalog name and price so items always add up to the subtotal
+        "items": [
+            {**item.model_dump(), "product_name": product["name"], "price": product["price"]}
+            for item, product in zip(data.items, reserved)
+        ],
         "subtotal": round(subtotal, 2),
         "tax": tax,
         "shipping": shipping,
@@ -723,46 +854,143 @@ async def create_order(data: OrderCreate, user: User = Depends(require_auth)):
         "payment_method": data.payment_method,
         "shipping_address": data.shipping_address,
         "tracking_number": None,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        # Cleared by whichever path gives the stock back, so it is returned at most once
+        "stock_reserved": True,
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.orders.insert_one(order)
-    order['created_at'] = datetime.fromisoformat(order['created_at'])
+    
+    # Broadcast inventory updates, one entry per product; repeated lines for the
+    # same product keep the lowest (latest) stock
+    stock_by_product = {}
+    for p in reserved:
+        stock_by_product[p["product_id"]] = min(p["stock"], stock_by_product.get(p["product_id"], p["stock"]))
+    await manager.broadcast({
+        "type": "inventory_update_batch",
+        "updates": [{"product_id": pid, "stock": stock} for pid, stock in stock_by_product.items()]
+    })
     
     return order
 
+async def release_stock(items: List[dict]):
+    # Return reserved units to the catalog, e.g. for a rejected or cancelled order
+    if not items:
+        return
+    await db.products.bulk_write([
+        UpdateOne({"product_id": item["product_id"]}, {"$inc": {"stock": item["quantity"]}})
+        for item in items
+    ], ordered=False)
+
+# How often the expiry sweep looks for unpaid orders past PENDING_ORDER_TTL_MINUTES
+ORDER_EXPIRY_INTERVAL = 300
+order_expiry_task: Optional[asyncio.Task] = None
+
+async def release_expired_orders():
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(minutes=PENDING_ORDER_TTL_MINUTES)
+    # Only untouched Stripe orders expire; PayPal isn't paid through the backend and
+    # orders an admin has moved on are kept. Orders wait for any open checkout
+    # session to end. Each claim clears stock_reserved atomically, so concurrent
+    # workers never release twice
+    while order := await db.orders.find_one_and_update(
+        {
+            "status": "pending",
+            "payment_status": "pending",
+            "payment_method": "stripe",
+            "stock_reserved": True,
+            "created_at": {"$lt": cutoff},
+            "$or": [
+                {"checkout_expires_at": {"$exists": False}},
+                {"checkout_expires_at": {"$lt": now}}
+            ]
+        },
+        {"$set": {"status": "cancelled", "stock_reserved": False}},
+        projection={"_id": 0, "items": 1}
+    ):
+        await release_stock(order["items"])
+
+async def expire_unpaid_orders():
+    while True:
+        try:
+            await release_expired_orders()
+        except PyMongoError:
+            logger.exception("Failed to release stock held by expired orders")
+        await asyncio.sleep(ORDER_EXPIRY_INTERVAL)
+
 @api_router.put("/orders/{order_id}/status")
 async def update_order_status(order_id: str, status: str, user: User = Depends(require_admin)):
     valid_statuses = ["pending", "processing", "shipped", "delivered", "cancelled"]
     if status not in valid_statuses:
         raise HTTPException(status_code=400, detail="Invalid status")
     
-    result = await db.orders.update_one(
+    if status == "cancelled":
+        # Clearing the flag in the same write means stock is given back once, even if
+        # the order is reopened and cancelled again
+        order = await db.orders.find_one_and_update(
+            {"order_id": order_id, "stock_reserved": True},
+            {"$set": {"status": status, "stock_reserved": False}},
+            projection={"_id": 0, "stock_reserved": 0, "checkout_expires_at": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if order:
+            await release_stock(order["items"])
+            return {"message": "Status updated", "order": order}
+    
+    order = await db.orders.find_one_and_update(
         {"order_id": order_id},
-        {"$set": {"status": status}}
+        {"$set": {"status": status}},
+        projection={"_id": 0, "stock_reserved": 0, "checkout_expires_at": 0},
+        return_document=ReturnDocument.AFTER
     )
-    
-    if result.modified_count == 0:
+    if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    return {"message": "Status updated"}
+    return {"message": "Status updated", "order": order}
 
 # ============== PAYMENT ROUTES ==============
 
+# Built on first use, since the webhook URL comes from the request's base URL
+stripe_checkout = None
+
+def get_stripe_checkout(request: Request):
+    global stripe_checkout
+    if stripe_checkout is None:
+        webhook_url = f"{request.base_url}api/webhook/stripe"
+        stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
+    return stripe_checkout
+
 @api_router.post("/payments/stripe/create-session")
 async def create_stripe_session(data: CheckoutRequest, request: Request, user: User = Depends(require_auth)):
-    order = await db.orders.find_one({"order_id": data.order_id, "user_id": user.user_id})
+    order = await db.orders.find_one(
+        {"order_id": data.order_id, "user_id": user.user_id},
+        {"_id": 0, "total": 1, "status": 1, "created_at": 1}
+    )
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
+    if order["status"] != "pending":
+        raise HTTPException(status_code=400, detail="Order is no longer awaiting payment")
+    
+    # Stripe keeps sessions open for 30 minutes to 24 hours (24 hours when the SDK
+    # picks). Recording the end on the order keeps the expiry sweep from releasing
+    # stock a still-open session could pay for
+    now = datetime.now(timezone.utc)
+    if STRIPE_SDK_AVAILABLE:
+        expires_at = now + timedelta(hours=24)
+    else:
+        order_expires_at = order["created_at"] + timedelta(minutes=PENDING_ORDER_TTL_MINUTES)
+        expires_at = min(max(order_expires_at, now + timedelta(minutes=31)), now + timedelta(hours=24))
     
-    try:
-        # Import Stripe integration
-        from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionRequest
-        
+    # The status filter loses cleanly to an expiry sweep or cancel that got there first
+    result = await db.orders.update_one(
+        {"order_id": data.order_id, "status": "pending"},
+        {"$max": {"checkout_expires_at": expires_at}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=400, detail="Order is no longer awaiting payment")
+    
+    if STRIPE_SDK_AVAILABLE:
         host_url = data.origin_url
-        webhook_url = f"{request.base_url}api/webhook/stripe"
-        
-        stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
         
         checkout_request = CheckoutSessionRequest(
             amount=float(order["total"]),
@@ -772,230 +1000,260 @@ async def create_stripe_session(data: CheckoutRequest, request: Request, user: U
             metadata={"order_id": data.order_id, "user_id": user.user_id}
         )
         
-        session = await stripe_checkout.create_checkout_session(checkout_request)
+        session = await get_stripe_checkout(request).create_checkout_session(checkout_request)
         
         # Store payment transaction
         await db.payment_transactions.insert_one({
-            "transaction_id": f"txn_{uuid.uuid4().hex[:8]}",
+            "transaction_id": generate_id("txn"),
             "session_id": session.session_id,
             "order_id": data.order_id,
             "user_id": user.user_id,
             "amount": order["total"],
             "currency": "usd",
             "payment_status": "initiated",
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         })
         
         return {"url": session.url, "session_id": session.session_id}
-    except ImportError:
+    else:
         # Fallback for when emergentintegrations is not available
-        import httpx
+        response = await http_client.post(
+            "https://api.stripe.com/v1/checkout/sessions",
+            auth=STRIPE_AUTH,
+            data={
+                "payment_method_types[]": "card",
+                "line_items[0][price_data][currency]": "usd",
+                "line_items[0][price_data][unit_amount]": int(order["total"] * 100),
+                "line_items[0][price_data][product_data][name]": f"Order {data.order_id}",
+                "line_items[0][quantity]": "1",
+                "mode": "payment",
+                "expires_at": int(expires_at.timestamp()),
+                "success_url": f"{data.origin_url}/order-success?session_id={{CHECKOUT_SESSION_ID}}",
+                "cancel_url": f"{data.origin_url}/checkout",
+                "metadata[order_id]": data.order_id,
+                "metadata[user_id]": user.user_id
+            }
+        )
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.stripe.com/v1/checkout/sessions",
-                auth=(STRIPE_API_KEY, ""),
-                data={
-                    "payment_method_types[]": "card",
-                    "line_items[0][price_data][currency]": "usd",
-                    "line_items[0][price_data][unit_amount]": int(order["total"] * 100),
-                    "line_items[0][price_data][product_data][name]": f"Order {data.order_id}",
-                    "line_items[0][quantity]": "1",
-                    "mode": "payment",
-                    "success_url": f"{data.origin_url}/order-success?session_id={{CHECKOUT_SESSION_ID}}",
-                    "cancel_url": f"{data.origin_url}/checkout",
-                    "metadata[order_id]": data.order_id,
-                    "metadata[user_id]": user.user_id
-                }
-            )
-            
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail="Failed to create checkout session")
-            
-            session_data = response.json()
-            
-            # Store payment transaction
-            await db.payment_transactions.insert_one({
-                "transaction_id": f"txn_{uuid.uuid4().hex[:8]}",
-                "session_id": session_data["id"],
-                "order_id": data.order_id,
-                "user_id": user.user_id,
-                "amount": order["total"],
-                "currency": "usd",
-                "payment_status": "initiated",
-                "created_at": datetime.now(timezone.utc).isoformat()
-            })
-            
-            return {"url": session_data["url"], "session_id": session_data["id"]}
+        if response.status_code != 200:
+            raise HTTPException(status_code=400, detail="Failed to create checkout session")
+        
+        session_data = response.json()
+        
+        # Store payment transaction
+        await db.payment_transactions.insert_one({
+            "transaction_id": generate_id("txn"),
+            "session_id": session_data["id"],
+            "order_id": data.order_id,
+            "user_id": user.user_id,
+            "amount": order["total"],
+            "currency": "usd",
+            "payment_status": "initiated",
+            "created_at": datetime.now(timezone.utc)
+        })
+        
+        return {"url": session_data["url"], "session_id": session_data["id"]}
+
+async def apply_payment_updates(transaction: dict, session=None):
+    # The guard makes replays (concurrent polls, transaction retries) no-ops
+    result = await db.payment_transactions.update_one(
+        {"session_id": transaction["session_id"], "payment_status": {"$ne": "paid"}},
+        {"$set": {"payment_status": "paid"}},
+        session=session
+    )
+    if result.modified_count == 0:
+        return []
+    
+    stock_updates = []
+    # BEFORE tells us whether the order still holds its stock
+    if order := await db.orders.find_one_and_update(
+        {"order_id": transaction["order_id"]},
+        {"$set": {"payment_status": "paid", "status": "processing", "stock_reserved": True}},
+        projection={"_id": 0, "total": 1, "items": 1, "stock_reserved": 1},
+        return_document=ReturnDocument.BEFORE,
+        session=session
+    ):
+        # Expired orders (and ones placed before reservation at checkout) take stock
+        # now, but never below zero; the payment has already gone through either way
+        if not order.get("stock_reserved"):
+            for item in order["items"]:
+                product = await db.products.find_one_and_update(
+                    {"product_id": item["product_id"], "stock": {"$gte": item["quantity"]}},
+                    {"$inc": {"stock": -item["quantity"]}},
+                    projection={"_id": 0, "product_id": 1, "stock": 1},
+                    return_document=ReturnDocument.AFTER,
+                    session=session
+                )
+                if product:
+                    stock_updates.append(product)
+                else:
+                    logger.warning("Paid order %s is short of stock for product %s",
+                                   transaction["order_id"], item["product_id"])
+        
+        # Add loyalty points
+        points = int(order["total"])
+        await db.users.update_one(
+            {"user_id": transaction["user_id"]},
+            {"$inc": {"loyalty_points": points}},
+            session=session
+        )
+    
+    return stock_updates
+
+async def complete_payment(transaction: dict):
+    # Commit the transaction, order and loyalty updates together where the deployment allows it
+    if not transactions_supported:
+        stock_updates = await apply_payment_updates(transaction)
+    else:
+        async with await client.start_session() as session:
+            stock_updates = await session.with_transaction(lambda s: apply_payment_updates(transaction, s))
+    
+    # Broadcast only once the stock change has committed
+    if stock_updates:
+        await manager.broadcast({"type": "inventory_update_batch", "updates": stock_updates})
+
+async def fetch_checkout_status(session_id: str, request: Request) -> Optional[dict]:
+    # Stripe's own view of the session; None when the REST fallback can't read it
+    if STRIPE_SDK_AVAILABLE:
+        status = await get_stripe_checkout(request).get_checkout_status(session_id)
+        return {"status": status.status, "payment_status": status.payment_status}
+    
+    # Fallback
+    response = await http_client.get(
+        f"https://api.stripe.com/v1/checkout/sessions/{session_id}",
+        auth=STRIPE_AUTH
+    )
+    if response.status_code != 200:
+        return None
+    
+    data = response.json()
+    return {"status": data.get("status"), "payment_status": data.get("payment_status")}
 
 @api_router.get("/payments/status/{session_id}")
-async def get_payment_status(session_id: str, user: User = Depends(require_auth)):
+async def get_payment_status(session_id: str, request: Request, user: User = Depends(require_auth)):
     transaction = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
     if not transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
     
-    try:
-        from emergentintegrations.payments.stripe.checkout import StripeCheckout
-        
-        stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url="")
-        status = await stripe_checkout.get_checkout_status(session_id)
-        
-        if status.payment_status == "paid" and transaction["payment_status"] != "paid":
-            # Update transaction and order
-            await db.payment_transactions.update_one(
-                {"session_id": session_id},
-                {"$set": {"payment_status": "paid"}}
-            )
-            await db.orders.update_one(
-                {"order_id": transaction["order_id"]},
-                {"$set": {"payment_status": "paid", "status": "processing"}}
-            )
-            
-            # Update inventory
-            order = await db.orders.find_one({"order_id": transaction["order_id"]})
-            if order:
-                for item in order["items"]:
-                    await db.products.update_one(
-                        {"product_id": item["product_id"]},
-                        {"$inc": {"stock": -item["quantity"]}}
-                    )
-                    # Broadcast inventory update
-                    product = await db.products.find_one({"product_id": item["product_id"]})
-                    if product:
-                        await manager.broadcast({
-                            "type": "inventory_update",
-                            "product_id": item["product_id"],
-                            "stock": product["stock"]
-                        })
-            
-            # Add loyalty points
-            points = int(order["total"])
-            await db.users.update_one(
-                {"user_id": transaction["user_id"]},
-                {"$inc": {"loyalty_points": points}}
-            )
-        
-        return {
-            "status": status.status,
-            "payment_status": status.payment_status,
-            "order_id": transaction["order_id"]
-        }
-    except ImportError:
-        # Fallback
-        import httpx
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"https://api.stripe.com/v1/checkout/sessions/{session_id}",
-                auth=(STRIPE_API_KEY, "")
-            )
-            
-            if response.status_code != 200:
-                return {"status": "unknown", "payment_status": transaction["payment_status"]}
-            
-            data = response.json()
-            
-            if data.get("payment_status") == "paid" and transaction["payment_status"] != "paid":
-                await db.payment_transactions.update_one(
-                    {"session_id": session_id},
-                    {"$set": {"payment_status": "paid"}}
-                )
-                await db.orders.update_one(
-                    {"order_id": transaction["order_id"]},
-                    {"$set": {"payment_status": "paid", "status": "processing"}}
-                )
-                
-                # Update inventory
-                order = await db.orders.find_one({"order_id": transaction["order_id"]})
-                if order:
-                    for item in order["items"]:
-                        await db.products.update_one(
-                            {"product_id": item["product_id"]},
-                            {"$inc": {"stock": -item["quantity"]}}
-                        )
-                    
-                    # Add loyalty points
-                    points = int(order["total"])
-                    await db.users.update_one(
-                        {"user_id": transaction["user_id"]},
-                        {"$inc": {"loyalty_points": points}}
-                    )
-            
-            return {
-                "status": data.get("status"),
-                "payment_status": data.get("payment_status"),
-                "order_id": transaction["order_id"]
-            }
+    checkout = await fetch_checkout_status(session_id, request)
+    if checkout is None:
+        return {"status": "unknown", "payment_status": transaction["payment_status"]}
+    
+    if checkout["payment_status"] == "paid" and transaction["payment_status"] != "paid":
+        await complete_payment(transaction)
+    
+    return {**checkout, "order_id": transaction["order_id"]}
 
 @api_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request):
-    body = await request.body()
-    # Handle webhook (simplified)
+    # Skip reading and parsing events we don't handle when the type is announced up front
+    event_type = request.headers.get("stripe-event-type")
+    if event_type and event_type != "checkout.session.completed":
+        return {"received": True}
+    
+    # Malformed events are acknowledged; Stripe retrying them would not help
     try:
-        data = json.loads(body)
-        if data.get("type") == "checkout.session.completed":
-            session = data["data"]["object"]
-            session_id = session["id"]
-            
-            await db.payment_transactions.update_one(
-                {"session_id": session_id},
-                {"$set": {"payment_status": "paid"}}
-            )
-            
-            transaction = await db.payment_transactions.find_one({"session_id": session_id})
-            if transaction:
-                await db.orders.update_one(
-                    {"order_id": transaction["order_id"]},
-                    {"$set": {"payment_status": "paid", "status": "processing"}}
-                )
-    except:
-        pass
+        data = orjson.loads(await request.body())
+        if data.get("type") != "checkout.session.completed":
+            return {"received": True}
+        session_id = data["data"]["object"]["id"]
+    except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+        logger.warning(f"Ignoring malformed Stripe webhook: {e!r}")
+        return {"received": True}
+    
+    # Same guarded path as the status poll, so whichever arrives second is a no-op
+    try:
+        transaction = await db.payment_transactions.find_one(
+            {"session_id": session_id},
+            {"_id": 0, "session_id": 1, "order_id": 1, "user_id": 1}
+        )
+        # The event body isn't signature-checked, so only record a payment Stripe confirms
+        if transaction:
+            checkout = await fetch_checkout_status(session_id, request)
+            if checkout is None:
+                # Stripe couldn't confirm the session; fail so the event is redelivered
+                logger.error(f"Could not confirm Stripe session {session_id} for webhook")
+                raise HTTPException(status_code=500, detail="Webhook processing failed")
+            if checkout["payment_status"] == "paid":
+                await complete_payment(transaction)
+    except (PyMongoError, httpx.HTTPError):
+        # A 5xx makes Stripe redeliver; the replay is safe
+        logger.exception(f"Failed to record Stripe payment for session {session_id}")
+        raise HTTPException(status_code=500, detail="Webhook processing failed")
     
     return {"received": True}
 
 # ============== AI RECOMMENDATIONS ==============
 
+async def get_trending():
+    trending = trending_cache.get("trending")
+    if trending is not None:
+        return trending
+    
+    # One query refills the cache even when many requests miss at once
+    async with trending_lock:
+        trending = trending_cache.get("trending")
+        if trending is None:
+            trending = await db.products.find({}, {"_id": 0}).sort("review_count", -1).limit(8).to_list(8)
+            trending_cache["trending"] = trending
+    return trending
+
 @api_router.get("/recommendations")
 async def get_recommendations(user: Optional[User] = Depends(get_current_user)):
-    # Get trending/popular products
-    trending = await db.products.find({}, {"_id": 0}).sort("review_count", -1).limit(8).to_list(8)
-    
-    for p in trending:
-        if isinstance(p.get('created_at'), str):
-            p['created_at'] = datetime.fromisoformat(p['created_at'])
-    
+    # Returning ORJSONResponse skips the jsonable_encoder pass a plain dict would get
     if not user:
-        return {"recommendations": trending, "type": "trending"}
-    
-    # Get user's order history for personalized recommendations
-    orders = await db.orders.find({"user_id": user.user_id}).to_list(10)
-    if not orders:
-        return {"recommendations": trending, "type": "trending"}
-    
-    # Get categories from user's purchases
-    purchased_products = []
-    for order in orders:
-        for item in order["items"]:
-            purchased_products.append(item["product_id"])
-    
-    if purchased_products:
-        products = await db.products.find({"product_id": {"$in": purchased_products}}).to_list(100)
-        categories = list(set(p["category_id"] for p in products))
-        
-        # Recommend from same categories
-        recommendations = await db.products.find(
-            {"category_id": {"$in": categories}, "product_id": {"$nin": purchased_products}},
-            {"_id": 0}
-        ).limit(8).to_list(8)
-        
-        for p in recommendations:
-            if isinstance(p.get('created_at'), str):
-                p['created_at'] = datetime.fromisoformat(p['created_at'])
-        
-        if recommendations:
-            return {"recommendations": recommendations, "type": "personalized"}
-    
-    return {"recommendations": trending, "type": "trending"}
+        return ORJSONResponse({"recommendations": await get_trending(), "type": "trending"})
+    
+    # Recommend unpurchased products from the categories of the user's last
+    # orders, resolved in a single pipeline
+    result = await db.orders.aggregate([
+        {"$match": {"user_id": user.user_id}},
+        {"$sort": {"created_at": -1}},
+        {"$limit": 10},
+        {"$unwind": "$items"},
+        {"$group": {"_id": None, "purchased": {"$addToSet": "$items.product_id"}}},
+        {"$lookup": {
+            "from": "products",
+            "localField": "purchased",
+            "foreignField": "product_id",
+            "pipeline": [{"$project": {"_id": 0, "category_id": 1}}],
+            "as": "purchased_products"
+        }},
+        {"$lookup": {
+            "from": "products",
+            "localField": "purchased_products.category_id",
+            "foreignField": "category_id",
+            "let": {"purchased": "$purchased"},
+            "pipeline": [
+                {"$match": {"$expr": {"$not": {"$in": ["$product_id", "$$purchased"]}}}},
+                {"$limit": 8},
+                {"$project": {"_id": 0}}
+            ],
+            "as": "recommendations"
+        }},
+        {"$project": {"_id": 0, "recommendations": 1}}
+    ]).to_list(1)
+    
+    recommendations = result[0]["recommendations"] if result else []
+    
+    if recommendations:
+        return ORJSONResponse({"recommendations": recommendations, "type": "personalized"})
+    
+    return ORJSONResponse({"recommendations": await get_trending(), "type": "trending"})
+
+# AI blurbs are cached per product; one shared client keeps its connection pool warm
+AI_CACHE_TTL = 6 * 3600
+AI_MAX_CONCURRENT_CALLS = 8
+ai_cache = TTLCache(maxsize=4096, ttl=AI_CACHE_TTL)
+ai_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENT_CALLS)
+openai_client = None
+
+def get_openai_client():
+    global openai_client
+    if openai_client is None:
+        from openai import AsyncOpenAI
+        openai_client = AsyncOpenAI(api_key=EMERGENT_LLM_KEY)
+    return openai_client
 
 @api_router.get("/recommendations/ai/{product_id}")
 async def get_ai_recommendations(product_id: str):
@@ -1009,101 +1267,99 @@ async def get_ai_recommendations(product_id: str):
         {"_id": 0}
     ).limit(4).to_list(4)
     
-    for p in similar:
-        if isinstance(p.get('created_at'), str):
-            p['created_at'] = datetime.fromisoformat(p['created_at'])
-    
     # Use AI for description if available
-    ai_description = None
-    if EMERGENT_LLM_KEY:
-        try:
-            from openai import AsyncOpenAI
-            
-            client = AsyncOpenAI(api_key=EMERGENT_LLM_KEY)
-            response = await client.chat.completions.create(
-                model="gpt-5.2",
-                messages=[
-                    {"role": "system", "content": "You are a helpful shopping assistant. Provide a brief recommendation."},
-                    {"role": "user", "content": f"Why should someone buy '{product['name']}'? Keep it to 2 sentences."}
-                ],
-                max_tokens=100
-            )
-            ai_description = response.choices[0].message.content
-        except:
-            pass
+    ai_description = ai_cache.get(product_id)
+    if ai_description is None and EMERGENT_LLM_KEY:
+        # Bound concurrent LLM calls so bursts don't trip upstream rate limits
+        async with ai_semaphore:
+            ai_description = ai_cache.get(product_id)
+            if ai_description is None:
+                try:
+                    response = await get_openai_client().chat.completions.create(
+                        model="gpt-5.2",
+                        messages=[
+                            {"role": "system", "content": "You are a helpful shopping assistant. Provide a brief recommendation."},
+                            {"role": "user", "content": f"Why should someone buy '{product['name']}'? Keep it to 2 sentences."}
+                        ],
+                        max_tokens=100
+                    )
+                    ai_description = response.choices[0].message.content
+                    if ai_description:
+                        ai_cache[product_id] = ai_description
+                except Exception as e:
+                    logger.warning(f"AI recommendation failed for {product_id}: {e!r}")
     
-    return {
+    return ORJSONResponse({
         "similar_products": similar,
         "ai_recommendation": ai_description
-    }
+    })
 
 # ============== NEWSLETTER ==============
 
 @api_router.post("/newsletter/subscribe")
 async def subscribe_newsletter(data: NewsletterSubscribe):
-    existing = await db.newsletter.find_one({"email": data.email})
-    if existing:
-        return {"message": "Already subscribed"}
-    
-    await db.newsletter.insert_one({
-        "email": data.email,
-        "subscribed_at": datetime.now(timezone.utc).isoformat()
-    })
-    return {"message": "Subscribed successfully"}
+    result = await db.newsletter.update_one(
+        {"email": data.email},
+        {"$setOnInsert": {"subscribed_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return {"message": "Subscribed successfully" if result.upserted_id else "Already subscribed"}
 
 # ============== ADMIN ROUTES ==============
 
 @api_router.get("/admin/stats")
 async def get_admin_stats(user: User = Depends(require_admin)):
-    total_users = await db.users.count_documents({})
-    total_products = await db.products.count_documents({})
-    total_orders = await db.orders.count_documents({})
-    
-    # Revenue calculation
-    orders = await db.orders.find({"payment_status": "paid"}).to_list(1000)
-    total_revenue = sum(o["total"] for o in orders)
-    
-    # Recent orders
-    recent_orders = await db.orders.find({}, {"_id": 0}).sort("created_at", -1).limit(10).to_list(10)
-    for o in recent_orders:
-        if isinstance(o.get('created_at'), str):
-            o['created_at'] = datetime.fromisoformat(o['created_at'])
-    
-    # Sales by day (last 7 days)
-    from datetime import timedelta
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    first_day = today - timedelta(days=6)
+    
+    # The counts, revenue, recent orders and daily sales are independent
+    total_users, total_products, total_orders, revenue, recent_orders, daily = await asyncio.gather(
+        db.users.count_documents({}),
+        db.products.count_documents({}),
+        db.orders.count_documents({}),
+        db.orders.aggregate([
+            {"$match": {"payment_status": "paid"}},
+            {"$group": {"_id": None, "total": {"$sum": "$total"}}}
+        ]).to_list(1),
+        db.orders.find({}, {"_id": 0, "stock_reserved": 0, "checkout_expires_at": 0}).sort("created_at", -1).limit(10).to_list(10),
+        # Sales by day (last 7 days), grouped server-side
+        db.orders.aggregate([
+            {"$match": {"payment_status": "paid", "created_at": {"$gte": first_day}}},
+            {"$group": {
+                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                "revenue": {"$sum": "$total"},
+                "orders": {"$sum": 1}
+            }}
+        ]).to_list(7)
+    )
+    
+    total_revenue = revenue[0]["total"] if revenue else 0
+    
+    daily_by_date = {d["_id"]: d for d in daily}
+    
     sales_by_day = []
     for i in range(7):
-        day = datetime.now(timezone.utc) - timedelta(days=i)
-        day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
-        day_end = day_start + timedelta(days=1)
-        
-        day_orders = await db.orders.find({
-            "payment_status": "paid",
-            "created_at": {"$gte": day_start.isoformat(), "$lt": day_end.isoformat()}
-        }).to_list(1000)
-        
+        date = (first_day + timedelta(days=i)).strftime("%Y-%m-%d")
+        day = daily_by_date.get(date, {})
         sales_by_day.append({
-            "date": day_start.strftime("%Y-%m-%d"),
-            "revenue": sum(o["total"] for o in day_orders),
-            "orders": len(day_orders)
+            "date": date,
+            "revenue": day.get("revenue", 0),
+            "orders": day.get("orders", 0)
         })
     
-    return {
+    return ORJSONResponse({
         "total_users": total_users,
         "total_products": total_products,
         "total_orders": total_orders,
         "total_revenue": round(total_revenue, 2),
         "recent_orders": recent_orders,
-        "sales_by_day": list(reversed(sales_by_day))
-    }
+        "sales_by_day": sales_by_day
+    })
 
 @api_router.get("/admin/users")
 async def get_all_users(user: User = Depends(require_admin)):
     users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
-    for u in users:
-        if isinstance(u.get('created_at'), str):
-            u['created_at'] = datetime.fromisoformat(u['created_at'])
-    return users
+    return ORJSONResponse(users)
 
 @api_router.put("/admin/users/{user_id}/role")
 async def update_user_role(user_id: str, role: str, admin: User = Depends(require_admin)):
@@ -1121,33 +1377,41 @@ async def update_user_role(user_id: str, role: str, admin: User = Depends(requir
 @api_router.get("/seller/products")
 async def get_seller_products(user: User = Depends(require_seller)):
     products = await db.products.find({"seller_id": user.user_id}, {"_id": 0}).to_list(100)
-    for p in products:
-        if isinstance(p.get('created_at'), str):
-            p['created_at'] = datetime.fromisoformat(p['created_at'])
-    return products
+    return ORJSONResponse(products)
 
 @api_router.get("/seller/stats")
 async def get_seller_stats(user: User = Depends(require_seller)):
-    products = await db.products.find({"seller_id": user.user_id}).to_list(100)
-    product_ids = [p["product_id"] for p in products]
-    
-    total_products = len(products)
-    total_stock = sum(p["stock"] for p in products)
-    
-    # Orders containing seller's products
-    orders = await db.orders.find({"items.product_id": {"$in": product_ids}}).to_list(1000)
-    
-    total_sales = 0
-    for order in orders:
-        for item in order["items"]:
-            if item["product_id"] in product_ids:
-                total_sales += item["price"] * item["quantity"]
+    inventory = await db.products.aggregate([
+        {"$match": {"seller_id": user.user_id}},
+        {"$group": {
+            "_id": None,
+            "product_ids": {"$push": "$product_id"},
+            "total_products": {"$sum": 1},
+            "total_stock": {"$sum": "$stock"}
+        }}
+    ]).to_list(1)
+    inventory = inventory[0] if inventory else {"product_ids": [], "total_products": 0, "total_stock": 0}
+    product_ids = inventory["product_ids"]
+    
+    # Sales of the seller's items across all orders containing them
+    sales = await db.orders.aggregate([
+        {"$match": {"items.product_id": {"$in": product_ids}}},
+        {"$unwind": "$items"},
+        {"$match": {"items.product_id": {"$in": product_ids}}},
+        {"$group": {
+            "_id": None,
+            "orders": {"$addToSet": "$_id"},
+            "total_sales": {"$sum": {"$multiply": ["$items.price", "$items.quantity"]}}
+        }},
+        {"$project": {"_id": 0, "total_orders": {"$size": "$orders"}, "total_sales": 1}}
+    ]).to_list(1)
+    sales = sales[0] if sales else {"total_orders": 0, "total_sales": 0}
     
     return {
-        "total_products": total_products,
-        "total_stock": total_stock,
-        "total_orders": len(orders),
-        "total_sales": round(total_sales, 2)
+        "total_products": inventory["total_products"],
+        "total_stock": inventory["total_stock"],
+        "total_orders": sales["total_orders"],
+        "total_sales": round(sales["total_sales"], 2)
     }
 
 # ============== WEBSOCKET ==============
@@ -1160,10 +1424,22 @@ async def websocket_inventory(websocket: WebSocket):
             data = await websocket.receive_text()
             # Echo back or handle commands
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        await manager.disconnect(websocket)
 
 # ============== SEED DATA ==============
 
+# Demo catalog; seller_id and created_at are filled in when seeding
+SEED_PRODUCTS = [
+    {"product_id": "prod_001", "name": "Wireless Bluetooth Headphones", "description": "Premium noise-cancelling headphones with 30-hour battery life", "price": 199.99, "category_id": "cat_electronics", "images": ["https://images.unsplash.com/photo-1505740420928-5e560c06d30e?w=500"], "stock": 50, "tags": ["audio", "bluetooth", "headphones"], "rating": 4.5, "review_count": 128},
+    {"product_id": "prod_002", "name": "Smart Watch Pro", "description": "Advanced fitness tracking with heart rate monitor and GPS", "price": 299.99, "category_id": "cat_electronics", "images": ["https://images.unsplash.com/photo-1523275335684-37898b6baf30?w=500"], "stock": 30, "tags": ["smartwatch", "fitness", "wearable"], "rating": 4.7, "review_count": 89},
+    {"product_id": "prod_003", "name": "Premium Leather Jacket", "description": "Genuine leather jacket with vintage styling", "price": 349.99, "category_id": "cat_fashion", "images": ["https://images.unsplash.com/photo-1551028719-00167b16eac5?w=500"], "stock": 20, "tags": ["leather", "jacket", "fashion"], "rating": 4.8, "review_count": 56},
+    {"product_id": "prod_004", "name": "Modern Desk Lamp", "description": "LED desk lamp with adjustable brightness and color temperature", "price": 79.99, "category_id": "cat_home", "images": ["https://images.unsplash.com/photo-1507473885765-e6ed057f782c?w=500"], "stock": 100, "tags": ["lamp", "led", "office"], "rating": 4.3, "review_count": 234},
+    {"product_id": "prod_005", "name": "Running Shoes Elite", "description": "Lightweight running shoes with advanced cushioning technology", "price": 149.99, "category_id": "cat_sports", "images": ["https://images.unsplash.com/photo-1542291026-7eec264c27ff?w=500"], "stock": 75, "tags": ["shoes", "running", "sports"], "rating": 4.6, "review_count": 312},
+    {"product_id": "prod_006", "name": "Minimalist Backpack", "description": "Water-resistant backpack with laptop compartment", "price": 89.99, "category_id": "cat_fashion", "images": ["https://images.unsplash.com/photo-1553062407-98eeb64c6a62?w=500"], "stock": 45, "tags": ["backpack", "bag", "travel"], "rating": 4.4, "review_count": 167},
+    {"product_id": "prod_007", "name": "Wireless Charging Pad", "description": "Fast wireless charger compatible with all Qi-enabled devices", "price": 39.99, "category_id": "cat_electronics", "images": ["https://images.unsplash.com/photo-1586816879360-004f5b0c51e5?w=500"], "stock": 200, "tags": ["charger", "wireless", "accessories"], "rating": 4.2, "review_count": 445},
+    {"product_id": "prod_008", "name": "Yoga Mat Premium", "description": "Extra thick non-slip yoga mat with carrying strap", "price": 49.99, "category_id": "cat_sports", "images": ["https://images.unsplash.com/photo-1601925260368-ae2f83cf8b7f?w=500"], "stock": 80, "tags": ["yoga", "fitness", "mat"], "rating": 4.5, "review_count": 198},
+]
+
 @api_router.post("/seed")
 async def seed_data():
     # Check if data exists
@@ -1181,43 +1457,36 @@ async def seed_data():
     ]
     await db.categories.insert_many(categories)
     
-    # Seed admin user
-    admin_id = f"user_{uuid.uuid4().hex[:12]}"
-    await db.users.insert_one({
-        "user_id": admin_id,
-        "email": "admin@nexusmarket.com",
-        "name": "Admin User",
-        "password_hash": hash_password("admin123"),
-        "role": "admin",
-        "picture": None,
-        "loyalty_points": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    })
-    
-    # Seed seller
-    seller_id = f"user_{uuid.uuid4().hex[:12]}"
-    await db.users.insert_one({
-        "user_id": seller_id,
-        "email": "seller@nexusmarket.com",
-        "name": "Demo Seller",
-        "password_hash": hash_password("seller123"),
-        "role": "seller",
-        "picture": None,
-        "loyalty_points": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    })
+    # Seed admin and seller users; the two bcrypt hashes run in parallel threads
+    admin_hash, seller_hash = await asyncio.gather(hash_password("admin123"), hash_password("seller123"))
+    now = datetime.now(timezone.utc)
+    admin_id = generate_id("user")
+    seller_id = generate_id("user")
+    await db.users.insert_many([
+        {
+            "user_id": admin_id,
+            "email": "admin@nexusmarket.com",
+            "name": "Admin User",
+            "password_hash": admin_hash,
+            "role": "admin",
+            "picture": None,
+            "loyalty_points": 0,
+            "created_at": now
+        },
+        {
+            "user_id": seller_id,
+            "email": "seller@nexusmarket.com",
+            "name": "Demo Seller",
+            "password_hash": seller_hash,
+            "role": "seller",
+            "picture": None,
+            "loyalty_points": 0,
+            "created_at": now
+        },
+    ], ordered=False)
     
     # Seed products
-    products = [
-        {"product_id": "prod_001", "seller_id": seller_id, "name": "Wireless Bluetooth Headphones", "description": "Premium noise-cancelling headphones with 30-hour battery life", "price": 199.99, "category_id": "cat_electronics", "images": ["https://images.unsplash.com/photo-1505740420928-5e560c06d30e?w=500"], "stock": 50, "tags": ["audio", "bluetooth", "headphones"], "rating": 4.5, "review_count": 128, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"product_id": "prod_002", "seller_id": seller_id, "name": "Smart Watch Pro", "description": "Advanced fitness tracking with heart rate monitor and GPS", "price": 299.99, "category_id": "cat_electronics", "images": ["https://images.unsplash.com/photo-1523275335684-37898b6baf30?w=500"], "stock": 30, "tags": ["smartwatch", "fitness", "wearable"], "rating": 4.7, "review_count": 89, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"product_id": "prod_003", "seller_id": seller_id, "name": "Premium Leather Jacket", "description": "Genuine leather jacket with vintage styling", "price": 349.99, "category_id": "cat_fashion", "images": ["https://images.unsplash.com/photo-1551028719-00167b16eac5?w=500"], "stock": 20, "tags": ["leather", "jacket", "fashion"], "rating": 4.8, "review_count": 56, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"product_id": "prod_004", "seller_id": seller_id, "name": "Modern Desk Lamp", "description": "LED desk lamp with adjustable brightness and color temperature", "price": 79.99, "category_id": "cat_home", "images": ["https://images.unsplash.com/photo-1507473885765-e6ed057f782c?w=500"], "stock": 100, "tags": ["lamp", "led", "office"], "rating": 4.3, "review_count": 234, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"product_id": "prod_005", "seller_id": seller_id, "name": "Running Shoes Elite", "description": "Lightweight running shoes with advanced cushioning technology", "price": 149.99, "category_id": "cat_sports", "images": ["https://images.unsplash.com/photo-1542291026-7eec264c27ff?w=500"], "stock": 75, "tags": ["shoes", "running", "sports"], "rating": 4.6, "review_count": 312, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"product_id": "prod_006", "seller_id": seller_id, "name": "Minimalist Backpack", "description": "Water-resistant backpack with laptop compartment", "price": 89.99, "category_id": "cat_fashion", "images": ["https://images.unsplash.com/photo-1553062407-98eeb64c6a62?w=500"], "stock": 45, "tags": ["backpack", "bag", "travel"], "rating": 4.4, "review_count": 167, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"product_id": "prod_007", "seller_id": seller_id, "name": "Wireless Charging Pad", "description": "Fast wireless charger compatible with all Qi-enabled devices", "price": 39.99, "category_id": "cat_electronics", "images": ["https://images.unsplash.com/photo-1586816879360-004f5b0c51e5?w=500"], "stock": 200, "tags": ["charger", "wireless", "accessories"], "rating": 4.2, "review_count": 445, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"product_id": "prod_008", "seller_id": seller_id, "name": "Yoga Mat Premium", "description": "Extra thick non-slip yoga mat with carrying strap", "price": 49.99, "category_id": "cat_sports", "images": ["https://images.unsplash.com/photo-1601925260368-ae2f83cf8b7f?w=500"], "stock": 80, "tags": ["yoga", "fitness", "mat"], "rating": 4.5, "review_count": 198, "created_at": datetime.now(timezone.utc).isoformat()},
-    ]
+    products = [{**p, "seller_id": seller_id, "created_at": now} for p in SEED_PRODUCTS]
     await db.products.insert_many(products)
     
     return {"message": "Data seeded successfully"}
@@ -1225,13 +1494,54 @@ async def seed_data():
 # Include the router in the main app
 app.include_router(api_router)
 
+# Comma-separated allowlist; "*" (the default) accepts any origin
+CORS_ORIGINS = frozenset(o.strip() for o in os.environ.get('CORS_ORIGINS', '*').split(',') if o.strip())
+
+# Everything in a preflight answer except the echoed origin and request headers is
+# fixed, so build it once
+PREFLIGHT_HEADERS = [
+    (b"access-control-allow-methods", b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"),
+    (b"access-control-allow-credentials", b"true"),
+    (b"access-control-max-age", b"600"),
+    (b"vary", b"Origin"),
+    (b"content-length", b"0"),
+]
+
+class PreflightMiddleware:
+    # Answers CORS preflights from allowed origins before they reach the router;
+    # anything else falls through to CORSMiddleware
+    def __init__(self, app):
+        self.app = app
+        self.allow_all = "*" in CORS_ORIGINS
+        self.allowed = frozenset(o.encode("latin-1") for o in CORS_ORIGINS)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "OPTIONS":
+            headers = dict(scope["headers"])
+            origin = headers.get(b"origin")
+            if origin and b"access-control-request-method" in headers and (self.allow_all or origin in self.allowed):
+                response_headers = [(b"access-control-allow-origin", origin), *PREFLIGHT_HEADERS]
+                # Allow whatever headers the browser asks for (e.g. X-Session-ID), like allow_headers=["*"]
+                requested_headers = headers.get(b"access-control-request-headers")
+                if requested_headers:
+                    response_headers.append((b"access-control-allow-headers", requested_headers))
+                await send({
+                    "type": "http.response.start",
+                    "status": 204,
+                    "headers": response_headers
+                })
+                await send({"type": "http.response.body", "body": b""})
+                return
+        await self.app(scope, receive, send)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
-    allow_origins=["*"],
+    allow_origins=list(CORS_ORIGINS),
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(PreflightMiddleware)
 
 # Configure logging
 logging.basicConfig(
@@ -1240,6 +1550,78 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def configure_executor():
+    # Size the pool used by asyncio.to_thread for concurrent bcrypt work
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2))
+
+@app.on_event("startup")
+async def create_http_client():
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+
+@app.on_event("startup")
+async def detect_transaction_support():
+    global transactions_supported
+    try:
+        hello = await client.admin.command("hello")
+    except PyMongoError:
+        return
+    transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+
+async def ensure_index(collection, keys, **kwargs):
+    # A failed index (e.g. duplicates left by older code) is logged instead of aborting startup
+    try:
+        await collection.create_index(keys, **kwargs)
+    except PyMongoError:
+        logger.exception(f"Could not create index {keys!r} on {collection.name}")
+
+@app.on_event("startup")
+async def create_indexes():
+    # Each index matches a query shape used by the handlers; build them concurrently
+    await asyncio.gather(
+        ensure_index(db.users, "user_id", unique=True),
+        ensure_index(db.users, "email", unique=True),
+        ensure_index(db.products, "product_id", unique=True),
+        ensure_index(db.products, [("category_id", 1), ("created_at", -1)]),
+        ensure_index(db.products, [("category_id", 1), ("product_id", 1)]),
+        ensure_index(db.products, [("price", 1)]),
+        ensure_index(db.products, [("rating", -1)]),
+        ensure_index(db.products, [("review_count", -1)]),
+        ensure_index(db.products, "seller_id"),
+        ensure_index(db.products, "name"),
+        ensure_index(db.products, [("name", "text"), ("description", "text"), ("tags", "text")]),
+        ensure_index(db.reviews, [("product_id", 1), ("created_at", -1)]),
+        ensure_index(db.reviews, [("product_id", 1), ("user_id", 1)], unique=True),
+        ensure_index(db.carts, "user_id", unique=True),
+        ensure_index(db.wishlists, "user_id", unique=True),
+        ensure_index(db.orders, [("user_id", 1), ("created_at", -1)]),
+        ensure_index(db.orders, [("created_at", -1)]),
+        ensure_index(db.orders, "order_id", unique=True),
+        ensure_index(db.orders, "items.product_id"),
+        ensure_index(db.orders, [("payment_status", 1), ("created_at", 1)]),
+        ensure_index(db.payment_transactions, "session_id", unique=True),
+        ensure_index(db.newsletter, "email", unique=True)
+    )
+
+@app.on_event("startup")
+async def start_order_expiry():
+    global order_expiry_task
+    order_expiry_task = asyncio.create_task(expire_unpaid_orders())
+
+@app.on_event("shutdown")
+async def stop_order_expiry():
+    if order_expiry_task:
+        order_expiry_task.cancel()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    if http_client:
+        await http_client.aclose()